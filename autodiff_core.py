@@ -0,0 +1,489 @@
+from collections import defaultdict
+import hashlib
+import math
+import pathlib
+import webbrowser
+import weakref
+
+from graphviz import Graph
+
+__all__ = [
+    "make_graph", "render_graph", "IDManager",
+    "Op", "NullaryOp", "UnaryOp", "BinaryOp",
+    "Number", "Var", "ExpOp", "exp", "ScaleOp", "MulOp", "AddOp",
+]
+
+
+# Bound once so ExpOp skips the global + attribute lookup on every evaluation.
+_exp = math.exp
+
+
+def _batch_exp(x):
+    # Only a batch of points needs NumPy, so it is imported here rather than by
+    # every user of the Op graph.
+    import numpy as np
+    return np.exp(x)
+
+################################################################################
+
+
+def make_graph(rankdir="RL"):
+    G = Graph()
+    fontname = "Roboto Mono"
+    G.attr("graph", rankdir=rankdir)
+    G.attr("graph", fontname=fontname)
+    G.attr("node", fontname=fontname)
+    G.attr("node", style="rounded")
+    G.attr("node", shape="box")
+    G.attr("edge", fontname=fontname)
+
+    return G
+
+
+def render_graph(G, filename=None):
+    """Render G to out-<hash of its DOT source>.svg and open it. The dot
+    invocation is skipped when the graph has been rendered before. With a
+    filename, e.g. "Graph.gv", G is always rendered to <filename>.svg and
+    the DOT source is kept next to it."""
+    if filename is not None:
+        G.render(filename, format="svg", view=True)
+        return
+    key = hashlib.sha1(G.source.encode()).hexdigest()
+    svg = pathlib.Path(f"out-{key}.svg")
+    if svg.exists():
+        webbrowser.open(svg.resolve().as_uri())
+    else:
+        G.render(svg.stem, format="svg", view=True, cleanup=True)
+
+################################################################################
+
+
+class IDManager:
+    def __init__(self):
+        self._id_counter = 1
+        # Weak references only: a DAG is freed once the last user reference to
+        # it goes away, instead of living here forever.
+        self.id_to_node = weakref.WeakValueDictionary()
+
+        # The managers that were current when this one was entered; a stack, so
+        # the same manager can be entered again while it is active.
+        self._outers = []
+
+    def new_id(self, node):
+        new_id = self._id_counter
+        self.id_to_node[new_id] = node
+        self._id_counter += 1
+        return new_id
+
+    # `with IDManager():` numbers the nodes built inside the block from 1,
+    # independently of the module-level idm.
+    def __enter__(self):
+        global idm
+        self._outers.append(idm)
+        idm = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global idm
+        idm = self._outers.pop()
+
+################################################################################
+
+
+idm = IDManager()
+
+################################################################################
+
+
+class Op:
+    __slots__ = ("__weakref__", "id", "fwd", "grad", "_topo_order")
+
+    def __init__(self):
+        self.id = idm.new_id(self)
+
+        self.fwd = None
+
+        self.grad = None
+
+        self._topo_order = None
+
+    @property
+    def id_str(self):
+        return f"w{self.id}"
+
+    def __repr__(self):
+        return self.id_str
+
+    def node_repr(self):
+        return (f"<<font color=\"blue\">{self.id_str}</font><br/>"
+                f"{self.__class__.__name__}{self._label_detail()}<br/>"
+                f"fwd: {self.fwd:.2f}<br/>"
+                f"grad: {self.grad:.2f}>")
+
+    # Leaves and ScaleOp add their constant or name after the class name.
+    def _label_detail(self):
+        return ""
+
+    def topo_sort(self):
+        """Return the nodes reachable from self in reverse topological order,
+        i.e. every node comes before its children. Cached on self."""
+        if self._topo_order is None:
+            order = []
+            visited = set()
+            stack = [(self, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if expanded:
+                    order.append(node)
+                    continue
+                if id(node) in visited:
+                    continue
+                visited.add(id(node))
+                stack.append((node, True))
+                for child in node.children():
+                    if id(child) not in visited:
+                        stack.append((child, False))
+            order.reverse()
+            self._topo_order = order
+        return self._topo_order
+
+    def forward(self, env):
+        for node in reversed(self.topo_sort()):
+            node._compute_fwd(env)
+        return self.fwd
+
+    def backward(self, parent_adjoint):
+        adjoints = defaultdict(int)
+        adjoints[id(self)] = parent_adjoint
+        for node in self.topo_sort():
+            node._compute_bwd(adjoints[id(node)], adjoints)
+
+    def graph(self, G):
+        # Write the DOT statements straight into G.body in one go instead of
+        # calling G.node()/G.edge() per node and edge. Labels are HTML-like
+        # (<...>), so they need no quoting. DOT nodes are named by position in
+        # topo_sort(), not by id: ids restart at 1 in every `with IDManager():`
+        # block, so a DAG mixing nodes from two managers can repeat them.
+        order = self.topo_sort()
+        names = {id(node): f"n{i}" for i, node in enumerate(order)}
+        lines = []
+        for node in order:
+            node._graph_lines(lines, names)
+        G.body.extend(lines)
+
+    def _dot_node(self, names):
+        return f"\t{names[id(self)]} [label={self.node_repr()}]\n"
+
+    def _dot_edge(self, names, child, label=None):
+        if label is None:
+            return f"\t{names[id(self)]} -- {names[id(child)]}\n"
+        return f"\t{names[id(self)]} -- {names[id(child)]} [label={label}]\n"
+
+    def compile(self, batch=False):
+        """Generate straight-line Python for the forward and backward pass of
+        the DAG under self and return it as (fwd, bwd). fwd(env) returns the
+        value and a tape of every intermediate, bwd(tape, g) returns
+        {name: gradient} with g as the adjoint of self. With batch=True the
+        env values are arrays of points instead of numbers."""
+        order = list(reversed(self.topo_sort()))
+        index = {id(node): i for i, node in enumerate(order)}
+
+        def v(node):
+            return f"v{index[id(node)]}"
+
+        def a(node):
+            return f"a{index[id(node)]}"
+
+        # Constants are passed in through the namespace as c0, c1, ...: the
+        # repr() of inf, nan or a NumPy scalar is not valid source.
+        consts = {}
+
+        def c(value):
+            name = f"c{len(consts)}"
+            consts[name] = float(value)
+            return name
+
+        tape = ", ".join(v(node) for node in order)
+
+        lines = ["def fwd(env):"]
+        for node in order:
+            lines.append(f"    {v(node)} = {node._fwd_source(v, c)}")
+        lines.append(f"    return {v(self)}, ({tape},)")
+
+        lines += ["", "def bwd(tape, g):", f"    ({tape},) = tape",
+                  f"    {a(self)} = g"]
+        # Adjoints are rebound (a = a + term), never updated in place: with a
+        # batch, a child of an AddOp starts out as the very array of its parent
+        # and g itself belongs to the caller.
+        assigned = {id(self)}
+        # One local per variable name, so a name used by many Var nodes does
+        # not turn into a single huge expression.
+        grads = {}
+        for node in reversed(order):
+            if isinstance(node, Var):
+                if node.name in grads:
+                    g = grads[node.name]
+                    lines.append(f"    {g} = {g} + {a(node)}")
+                else:
+                    grads[node.name] = g = f"g{len(grads)}"
+                    lines.append(f"    {g} = {a(node)}")
+            for child, term in node._bwd_source(v, a, c):
+                if id(child) in assigned:
+                    term = f"{a(child)} + {term}"
+                assigned.add(id(child))
+                lines.append(f"    {a(child)} = {term}")
+        lines.append("    return {" + ", ".join(
+            f"{name!r}: {g}" for name, g in grads.items()) + "}")
+
+        if batch:
+            import numpy as np
+            namespace = {"_exp": np.exp, **consts}
+        else:
+            namespace = {"_exp": _exp, **consts}
+        exec(compile("\n".join(lines), "<compiled Op>", "exec"), namespace)
+        return namespace["fwd"], namespace["bwd"]
+
+    # Arithmetic on constants is folded while the expression is built, so
+    # those nodes are never allocated.
+
+    def __mul__(self, other):
+        if isinstance(self, Number) and isinstance(other, Number):
+            return Number(self.value * other.value)
+        if isinstance(self, Number):
+            return other * self
+        if isinstance(other, Number):
+            if other.value == 0:
+                return Number(0)
+            if other.value == 1:
+                return self
+            return ScaleOp(self, other.value)
+        return MulOp(self, other)
+
+    def __add__(self, other):
+        if isinstance(self, Number) and isinstance(other, Number):
+            return Number(self.value + other.value)
+        if isinstance(other, Number) and other.value == 0:
+            return self
+        if isinstance(self, Number) and self.value == 0:
+            return other
+        return AddOp(self, other)
+
+
+class NullaryOp(Op):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__()
+
+    def children(self):
+        return ()
+
+    def _compute_bwd(self, parent_adjoint, adjoints):
+        if self.grad is None:
+            self.grad = parent_adjoint
+        else:
+            self.grad = self.grad + parent_adjoint
+
+    def _graph_lines(self, lines, names):
+        lines.append(self._dot_node(names))
+
+    def _bwd_source(self, v, a, c):
+        return []
+
+
+class UnaryOp(Op):
+    __slots__ = ("arg", "darg")
+
+    def __init__(self, arg):
+        super().__init__()
+
+        self.arg = arg
+
+        self.darg = None
+
+    def children(self):
+        return (self.arg,)
+
+    def _compute_bwd(self, parent_adjoint, adjoints):
+        if self.grad is None:
+            self.grad = parent_adjoint
+        else:
+            self.grad = self.grad + parent_adjoint
+        adjoints[id(self.arg)] += self.darg * parent_adjoint
+
+    def _graph_lines(self, lines, names):
+        lines.append(self._dot_node(names))
+        lines.append(self._dot_edge(names, self.arg, self.edge_repr()))
+
+    def edge_repr(self):
+        return f"<\u2202{self.id_str}/\u2202{self.arg.id_str}: {self.darg:.2f}>"
+
+
+class BinaryOp(Op):
+    __slots__ = ("lhs", "rhs", "dlhs", "drhs")
+
+    def __init__(self, lhs, rhs):
+        super().__init__()
+
+        self.lhs = lhs
+        self.rhs = rhs
+
+        self.dlhs = None
+        self.drhs = None
+
+    def children(self):
+        return (self.lhs, self.rhs)
+
+    def _compute_bwd(self, parent_adjoint, adjoints):
+        if self.grad is None:
+            self.grad = parent_adjoint
+        else:
+            self.grad = self.grad + parent_adjoint
+        adjoints[id(self.lhs)] += self.dlhs * parent_adjoint
+        adjoints[id(self.rhs)] += self.drhs * parent_adjoint
+
+    def _graph_lines(self, lines, names):
+        lines.append(self._dot_node(names))
+        lines.append(self._dot_edge(names, self.lhs, self.left_edge_repr()))
+        lines.append(self._dot_edge(names, self.rhs, self.right_edge_repr()))
+
+    def right_edge_repr(self):
+        return f"<\u2202{self.id_str}/\u2202{self.rhs.id_str}: {self.drhs:.2f}>"
+
+    def left_edge_repr(self):
+        return f"<\u2202{self.id_str}/\u2202{self.lhs.id_str}: {self.dlhs:.2f}>"
+
+################################################################################
+
+
+class Number(NullaryOp):
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def _label_detail(self):
+        return f": {self.value}"
+
+    def _compute_fwd(self, env):
+        self.fwd = self.value
+
+    def _fwd_source(self, v, c):
+        return c(self.value)
+
+
+class Var(NullaryOp):
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def _label_detail(self):
+        return f": {self.name}"
+
+    def _compute_fwd(self, env):
+        self.fwd = env[self.name]
+
+    def _fwd_source(self, v, c):
+        return f"env[{self.name!r}]"
+
+################################################################################
+
+
+class ExpOp(UnaryOp):
+    __slots__ = ()
+
+    def __init__(self, arg):
+        super().__init__(arg)
+
+    def _compute_fwd(self, env):
+        x = self.arg.fwd
+        # math.exp is about twice as fast as np.exp on a single number, and
+        # keeps NumPy out of scalar evaluation altogether.
+        self.fwd = _exp(x) if isinstance(x, (int, float)) else _batch_exp(x)
+        self.darg = self.fwd  # d/dx exp(x) = exp(x)
+
+    def _fwd_source(self, v, c):
+        return f"_exp({v(self.arg)})"
+
+    def _bwd_source(self, v, a, c):
+        return [(self.arg, f"{a(self)} * {v(self)}")]
+
+
+def exp(arg):
+    return ExpOp(arg)
+
+
+class ScaleOp(UnaryOp):
+    """arg * c for a constant c. c is kept as a plain number rather than a
+    Number node, so it takes no node and is never traversed."""
+    __slots__ = ("c",)
+
+    def __init__(self, arg, c):
+        super().__init__(arg)
+        self.c = c
+        self.darg = c
+
+    def _label_detail(self):
+        return f": {self.c}"
+
+    def _compute_fwd(self, env):
+        self.fwd = self.arg.fwd * self.c
+
+    def _fwd_source(self, v, c):
+        return f"{v(self.arg)} * {c(self.c)}"
+
+    def _bwd_source(self, v, a, c):
+        return [(self.arg, f"{a(self)} * {c(self.c)}")]
+
+################################################################################
+
+
+class MulOp(BinaryOp):
+    __slots__ = ()
+
+    def __init__(self, lhs, rhs):
+        super().__init__(lhs, rhs)
+
+    def _compute_fwd(self, env):
+        self.fwd = self.lhs.fwd * self.rhs.fwd
+        self.dlhs = self.rhs.fwd
+        self.drhs = self.lhs.fwd
+
+    def _fwd_source(self, v, c):
+        return f"{v(self.lhs)} * {v(self.rhs)}"
+
+    def _bwd_source(self, v, a, c):
+        return [(self.lhs, f"{a(self)} * {v(self.rhs)}"),
+                (self.rhs, f"{a(self)} * {v(self.lhs)}")]
+
+
+class AddOp(BinaryOp):
+    __slots__ = ()
+
+    def __init__(self, lhs, rhs):
+        super().__init__(lhs, rhs)
+
+        # Both partials of a sum are the constant 1; they are only kept for
+        # the graph labels, _compute_bwd passes the adjoint straight through.
+        self.dlhs = 1
+        self.drhs = 1
+
+    def _compute_fwd(self, env):
+        self.fwd = self.lhs.fwd + self.rhs.fwd
+
+    def _compute_bwd(self, parent_adjoint, adjoints):
+        if self.grad is None:
+            self.grad = parent_adjoint
+        else:
+            self.grad = self.grad + parent_adjoint
+        adjoints[id(self.lhs)] += parent_adjoint
+        adjoints[id(self.rhs)] += parent_adjoint
+
+    def _fwd_source(self, v, c):
+        return f"{v(self.lhs)} + {v(self.rhs)}"
+
+    def _bwd_source(self, v, a, c):
+        return [(self.lhs, a(self)), (self.rhs, a(self))]
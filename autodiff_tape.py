@@ -0,0 +1,198 @@
+import math
+
+from numba import njit, prange
+import numpy as np
+
+from autodiff_core import AddOp, ExpOp, MulOp, Number, ScaleOp, Var
+
+__all__ = ["Tape", "compile_tape"]
+
+# A DAG that is evaluated many times can be flattened once into a tape: parallel
+# arrays with one entry per node, leaves first, that are interpreted without
+# going through the Op objects. Every value on the tape may be a whole batch of
+# points, stored as one row per node.
+
+VAR, CONST, ADD, MUL, EXP, SCALE = range(6)
+
+
+class Tape:
+    def __init__(self, op_kind, lhs_idx, rhs_idx, const_val, var_names):
+        self.op_kind = op_kind
+        self.lhs_idx = lhs_idx
+        self.rhs_idx = rhs_idx
+        self.const_val = const_val
+        self.var_names = var_names
+        self._exp_nodes = np.flatnonzero(op_kind == EXP).tolist()
+
+    def forward(self, env):
+        """Evaluate every node at env and return the (N,) or (N, B) array of
+        values. env maps each name to a scalar or to an array of B points."""
+        env_vals = np.array([env[name] for name in self.var_names],
+                            dtype=float)
+        fwd = np.empty((len(self.op_kind),) + env_vals.shape[1:])
+        if fwd.ndim == 1:
+            _tape_forward(self.op_kind, self.lhs_idx, self.rhs_idx,
+                          self.const_val, env_vals, fwd)
+            return fwd
+        # Numba has no vectorised exp, math.exp over a row is several times
+        # slower than np.exp. The kernel runs up to each EXP node and np.exp
+        # fills in its row.
+        start = 0
+        for i in self._exp_nodes + [len(self.op_kind)]:
+            _tape_forward_batched(self.op_kind, self.lhs_idx, self.rhs_idx,
+                                  self.const_val, env_vals, fwd, start, i)
+            if i < len(self.op_kind):
+                np.exp(fwd[self.lhs_idx[i]], out=fwd[i])
+            start = i + 1
+        return fwd
+
+    def backward(self, fwd):
+        """Return {name: dz/dname} for the values returned by forward, z being
+        the last node on the tape."""
+        adj = np.zeros_like(fwd)
+        grads = np.zeros((len(self.var_names),) + fwd.shape[1:])
+        kernel = _tape_backward if fwd.ndim == 1 else _tape_backward_batched
+        kernel(self.op_kind, self.lhs_idx, self.rhs_idx, self.const_val,
+               fwd, adj, grads)
+        return dict(zip(self.var_names, grads))
+
+
+# The interpreter loops run under Numba; the if/elif ladder on op_kind lowers to
+# a jump table.
+
+@njit(cache=True)
+def _tape_forward(op_kind, lhs_idx, rhs_idx, const_val, env_vals, fwd):
+    for i in range(op_kind.shape[0]):
+        kind = op_kind[i]
+        if kind == VAR:
+            fwd[i] = env_vals[lhs_idx[i]]
+        elif kind == CONST:
+            fwd[i] = const_val[i]
+        elif kind == ADD:
+            fwd[i] = fwd[lhs_idx[i]] + fwd[rhs_idx[i]]
+        elif kind == MUL:
+            fwd[i] = fwd[lhs_idx[i]] * fwd[rhs_idx[i]]
+        elif kind == EXP:
+            fwd[i] = math.exp(fwd[lhs_idx[i]])
+        elif kind == SCALE:
+            fwd[i] = fwd[lhs_idx[i]] * const_val[i]
+
+
+@njit(cache=True)
+def _tape_backward(op_kind, lhs_idx, rhs_idx, const_val, fwd, adj, grads):
+    adj[-1] = 1.0
+    for i in range(op_kind.shape[0] - 1, -1, -1):
+        kind, lhs, rhs = op_kind[i], lhs_idx[i], rhs_idx[i]
+        if kind == VAR:
+            grads[lhs] += adj[i]
+        elif kind == ADD:
+            adj[lhs] += adj[i]
+            adj[rhs] += adj[i]
+        elif kind == MUL:
+            adj[lhs] += fwd[rhs] * adj[i]
+            adj[rhs] += fwd[lhs] * adj[i]
+        elif kind == EXP:
+            adj[lhs] += fwd[i] * adj[i]
+        elif kind == SCALE:
+            adj[lhs] += const_val[i] * adj[i]
+
+
+# Batched tapes are (N, B) and C-ordered, so a node's batch is one contiguous
+# row. Each thread takes a block of _BATCH_CHUNK columns and walks the nodes
+# over it: the inner loop then runs over contiguous memory and vectorises, and
+# no two threads write the same cache lines.
+_BATCH_CHUNK = 4096
+
+
+@njit(parallel=True, cache=True)
+def _tape_forward_batched(op_kind, lhs_idx, rhs_idx, const_val, env_vals, fwd,
+                          start, stop):
+    n_cols = fwd.shape[1]
+    for chunk in prange((n_cols + _BATCH_CHUNK - 1) // _BATCH_CHUNK):
+        lo = chunk * _BATCH_CHUNK
+        hi = min(lo + _BATCH_CHUNK, n_cols)
+        for i in range(start, stop):
+            kind, lhs, rhs = op_kind[i], lhs_idx[i], rhs_idx[i]
+            if kind == VAR:
+                for b in range(lo, hi):
+                    fwd[i, b] = env_vals[lhs, b]
+            elif kind == CONST:
+                for b in range(lo, hi):
+                    fwd[i, b] = const_val[i]
+            elif kind == ADD:
+                for b in range(lo, hi):
+                    fwd[i, b] = fwd[lhs, b] + fwd[rhs, b]
+            elif kind == MUL:
+                for b in range(lo, hi):
+                    fwd[i, b] = fwd[lhs, b] * fwd[rhs, b]
+            elif kind == SCALE:
+                for b in range(lo, hi):
+                    fwd[i, b] = fwd[lhs, b] * const_val[i]
+
+
+@njit(parallel=True, cache=True)
+def _tape_backward_batched(op_kind, lhs_idx, rhs_idx, const_val, fwd, adj,
+                           grads):
+    n_cols = fwd.shape[1]
+    last = op_kind.shape[0] - 1
+    for chunk in prange((n_cols + _BATCH_CHUNK - 1) // _BATCH_CHUNK):
+        lo = chunk * _BATCH_CHUNK
+        hi = min(lo + _BATCH_CHUNK, n_cols)
+        for b in range(lo, hi):
+            adj[last, b] = 1.0
+        for i in range(last, -1, -1):
+            kind, lhs, rhs = op_kind[i], lhs_idx[i], rhs_idx[i]
+            if kind == VAR:
+                for b in range(lo, hi):
+                    grads[lhs, b] += adj[i, b]
+            elif kind == ADD:
+                for b in range(lo, hi):
+                    adj[lhs, b] += adj[i, b]
+                    adj[rhs, b] += adj[i, b]
+            elif kind == MUL:
+                for b in range(lo, hi):
+                    adj[lhs, b] += fwd[rhs, b] * adj[i, b]
+                    adj[rhs, b] += fwd[lhs, b] * adj[i, b]
+            elif kind == EXP:
+                for b in range(lo, hi):
+                    adj[lhs, b] += fwd[i, b] * adj[i, b]
+            elif kind == SCALE:
+                for b in range(lo, hi):
+                    adj[lhs, b] += const_val[i] * adj[i, b]
+
+
+def compile_tape(root):
+    """Flatten the DAG under root into a Tape. For a VAR entry lhs_idx is the
+    index of its name in var_names, for CONST and SCALE entries const_val holds
+    the constant."""
+    order = list(reversed(root.topo_sort()))
+    index = {id(node): i for i, node in enumerate(order)}
+
+    op_kind = np.empty(len(order), dtype=np.int64)
+    lhs_idx = np.full(len(order), -1, dtype=np.int64)
+    rhs_idx = np.full(len(order), -1, dtype=np.int64)
+    const_val = np.zeros(len(order))
+    var_index = {}
+
+    for i, node in enumerate(order):
+        if isinstance(node, Var):
+            op_kind[i] = VAR
+            lhs_idx[i] = var_index.setdefault(node.name, len(var_index))
+        elif isinstance(node, Number):
+            op_kind[i] = CONST
+            const_val[i] = node.value
+        elif isinstance(node, ExpOp):
+            op_kind[i] = EXP
+            lhs_idx[i] = index[id(node.arg)]
+        elif isinstance(node, ScaleOp):
+            op_kind[i] = SCALE
+            lhs_idx[i] = index[id(node.arg)]
+            const_val[i] = node.c
+        elif isinstance(node, (AddOp, MulOp)):
+            op_kind[i] = ADD if isinstance(node, AddOp) else MUL
+            lhs_idx[i] = index[id(node.lhs)]
+            rhs_idx[i] = index[id(node.rhs)]
+        else:
+            raise TypeError(f"cannot compile {node.__class__.__name__}")
+
+    return Tape(op_kind, lhs_idx, rhs_idx, const_val, list(var_index))
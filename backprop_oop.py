@@ -1,231 +1,9 @@
 import math
 
-from graphviz import Graph
+import numpy as np
 
-################################################################################
-
-
-def make_graph():
-    G = Graph()
-    fontname = "Roboto Mono"
-    G.attr("graph", rankdir="RL")
-    G.attr("graph", fontname=fontname)
-    G.attr("node", fontname=fontname)
-    G.attr("node", style="rounded")
-    G.attr("node", shape="box")
-    G.attr("edge", fontname=fontname)
-
-    return G
-
-################################################################################
-
-
-class IDManager:
-    def __init__(self):
-        self._id_counter = 1
-        self.id_to_node = {}
-
-    def new_id(self, node):
-        new_id = f"w{self._id_counter}"
-        self.id_to_node[new_id] = node
-        self._id_counter += 1
-        return new_id
-
-################################################################################
-
-
-idm = IDManager()
-
-################################################################################
-
-
-class Op:
-    def __init__(self):
-        self.id = idm.new_id(self)
-        self.parents = []
-
-        self.fwd = None
-
-        self.grad = None
-
-    def __repr__(self):
-        return self.id
-
-    def __mul__(self, other):
-        return MulOp(self, other)
-
-    def __add__(self, other):
-        return AddOp(self, other)
-
-
-class NullaryOp(Op):
-    def __init__(self):
-        super().__init__()
-
-    def backward(self, parent_adjoint):
-        if self.grad is None:
-            self.grad = parent_adjoint
-        else:
-            self.grad += parent_adjoint
-
-    def graph(self, G):
-        G.node(
-            self.id, self.node_repr())
-
-    def node_repr(self):
-        return (f"<<font color=\"blue\">{self.id}</font><br/>"
-                f"{self.__class__.__name__}<br/>"
-                f"fwd: {self.fwd:.2f}<br/>"
-                f"grad: {self.grad:.2f}>")
-
-
-class UnaryOp(Op):
-    def __init__(self, arg):
-        super().__init__()
-
-        arg.parents.append(self)
-
-        self.arg = arg
-
-        self.darg = None
-
-    def backward(self, parent_adjoint):
-        if self.grad is None:
-            self.grad = parent_adjoint
-        else:
-            self.grad += parent_adjoint
-        self.arg.backward(self.darg * parent_adjoint)
-
-    def graph(self, G):
-        G.node(
-            self.id, self.node_repr())
-        G.edge(self.id, self.arg.id, self.edge_repr())
-        self.arg.graph(G)
-
-    def node_repr(self):
-        return (f"<<font color=\"blue\">{self.id}</font><br/>"
-                f"{self.__class__.__name__}<br/>"
-                f"fwd: {self.fwd:.2f}<br/>"
-                f"grad: {self.grad:.2f}>")
-
-    def edge_repr(self):
-        return(f"\u2202{self.id}/\u2202{self.arg.id}: {self.darg:.2f}")
-
-
-class BinaryOp(Op):
-    def __init__(self, lhs, rhs):
-        super().__init__()
-
-        lhs.parents.append(self)
-        rhs.parents.append(self)
-
-        self.lhs = lhs
-        self.rhs = rhs
-
-        self.dlhs = None
-        self.drhs = None
-
-    def backward(self, parent_adjoint):
-        if self.grad is None:
-            self.grad = parent_adjoint
-        else:
-            self.grad += parent_adjoint
-        self.lhs.backward(self.dlhs * parent_adjoint)
-        self.rhs.backward(self.drhs * parent_adjoint)
-
-    def graph(self, G):
-        G.node(
-            self.id, self.node_repr())
-        G.edge(self.id, self.lhs.id, self.left_edge_repr())
-        G.edge(self.id, self.rhs.id, self.right_edge_repr())
-        self.rhs.graph(G)
-        self.lhs.graph(G)
-
-    def node_repr(self):
-        return (f"<<font color=\"blue\">{self.id}</font><br/>"
-                f"{self.__class__.__name__}<br/>"
-                f"fwd: {self.fwd:.2f}<br/>"
-                f"grad: {self.grad:.2f}>")
-
-    def right_edge_repr(self):
-        return f"<\u2202{self.id}/\u2202{self.rhs.id}: {self.drhs:.2f}>"
-
-    def left_edge_repr(self):
-        return f"<\u2202{self.id}/\u2202{self.lhs.id}: {self.dlhs:.2f}>"
-
-################################################################################
-
-
-class Number(NullaryOp):
-    def __init__(self, value):
-        super().__init__()
-        self.value = value
-
-    def node_repr(self):
-        return (f"<<font color=\"blue\">{self.id}</font><br/>"
-                f"{self.__class__.__name__}: {self.value}<br/>"
-                f"fwd: {self.fwd:.2f}<br/>"
-                f"grad: {self.grad:.2f}>")
-
-    def forward(self, env):
-        self.fwd = self.value
-        return self.fwd
-
-
-class Var(NullaryOp):
-    def __init__(self, name):
-        super().__init__()
-        self.name = name
-
-    def node_repr(self):
-        return (f"<<font color=\"blue\">{self.id}</font><br/>"
-                f"{self.__class__.__name__}: {self.name}<br/>"
-                f"fwd: {self.fwd:.2f}<br/>"
-                f"grad: {self.grad:.2f}>")
-
-    def forward(self, env):
-        self.fwd = env[self.name]
-        return self.fwd
-
-################################################################################
-
-
-class ExpOp(UnaryOp):
-    def __init__(self, arg):
-        super().__init__(arg)
-
-    def forward(self, env):
-        self.fwd = math.exp(self.arg.forward(env))
-        self.darg = math.exp(self.arg.fwd)
-        return self.fwd
-
-
-def exp(arg):
-    return ExpOp(arg)
-
-################################################################################
-
-
-class MulOp(BinaryOp):
-    def __init__(self, lhs, rhs):
-        super().__init__(lhs, rhs)
-
-    def forward(self, env):
-        self.fwd = self.lhs.forward(env) * self.rhs.forward(env)
-        self.dlhs = self.rhs.fwd
-        self.drhs = self.lhs.fwd
-        return self.fwd
-
-
-class AddOp(BinaryOp):
-    def __init__(self, lhs, rhs):
-        super().__init__(lhs, rhs)
-
-    def forward(self, env):
-        self.fwd = self.lhs.forward(env) + self.rhs.forward(env)
-        self.dlhs = 1
-        self.drhs = 1
-        return self.fwd
+from autodiff_core import *
+from autodiff_tape import *
 
 ################################################################################
 
@@ -242,8 +20,53 @@ assert (abs(z.forward({"x1": 0.2, "x2": 0.3}) - math.exp(1.06)) <= 5*1e-15)
 # adjoint with the edge's adjoint.
 z.backward(1)  # 1 = dz/dz = z̅
 
+# x1 is shared by both products, so its gradient sums both paths.
+assert (abs(x1.grad - math.exp(1.06)*(0.3 + 5)) <= 5*1e-15)
+assert (abs(x2.grad - math.exp(1.06)*0.2) <= 5*1e-15)
+
+# The same DAG as a tape, evaluated at that point and two more in one go.
+tape = compile_tape(z)
+fwd = tape.forward({"x1": np.array([0.2, 1.0, 0.5]),
+                    "x2": np.array([0.3, 0.1, 2.0])})
+grads = tape.backward(fwd)
+assert (abs(fwd[-1][0] - z.fwd) <= 5*1e-15)
+assert (abs(grads["x1"][0] - x1.grad) <= 5*1e-15)
+assert (abs(grads["x2"][2] - math.exp(0.5*2.0 + 5*0.5)*0.5) <= 5*1e-14)
+
+# The Op graph itself also takes arrays: every node then holds a batch of
+# values and adjoints. Fresh Vars, since x1 and x2 already hold scalar grads,
+# numbered separately from the DAG that is drawn below.
+with IDManager():
+    y1 = Var("x1")
+    y2 = Var("x2")
+    zb = exp(y1*y2 + Number(5)*y1)
+zb.forward({"x1": np.array([0.2, 1.0, 0.5]), "x2": np.array([0.3, 0.1, 2.0])})
+zb.backward(1)
+assert (np.all(abs(zb.fwd - fwd[-1]) <= 5*1e-14))
+assert (np.all(abs(y1.grad - grads["x1"]) <= 5*1e-14))
+assert (np.all(abs(y2.grad - grads["x2"]) <= 5*1e-14))
+
+# The same DAG compiled to a pair of plain Python functions.
+fwd_fn, bwd_fn = z.compile()
+value, tape = fwd_fn({"x1": 0.2, "x2": 0.3})
+grads = bwd_fn(tape, 1)
+assert (abs(value - z.fwd) <= 5*1e-15)
+assert (abs(grads["x1"] - x1.grad) <= 5*1e-15)
+assert (abs(grads["x2"] - x2.grad) <= 5*1e-15)
+
+# Compiled, batched and with a seed array that must come back untouched. The
+# adjoint of each sum reaches x1 and x2 twice: d/dx1 (x1 + x2)^2 = 2(x1 + x2).
+w = (x2 + x1) * (x1 + x2)
+fwd_fn, bwd_fn = w.compile(batch=True)
+seed = np.ones(2)
+value, tape = fwd_fn({"x1": np.array([0.2, 0.5]), "x2": np.array([0.3, -0.4])})
+grads = bwd_fn(tape, seed)
+assert (np.all(abs(grads["x1"] - np.array([1.0, 0.2])) <= 5*1e-15))
+assert (np.all(abs(grads["x2"] - np.array([1.0, 0.2])) <= 5*1e-15))
+assert (np.all(seed == 1))
+
 ################################################################################
 
 G = make_graph()
 z.graph(G)
-G.render(view=True, format="svg")
+render_graph(G)
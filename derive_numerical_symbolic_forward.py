@@ -1,159 +1,248 @@
 import unittest
+import weakref
+
+
+# Every Expr is hash-consed: building an expression that is structurally equal to
+# an existing one returns the existing object, so repeated subexpressions are
+# shared and the expression is a DAG rather than a tree. Entries go away with the
+# last expression that uses them.
+_cons_cache = weakref.WeakValueDictionary()
+
+# derive_forward caches its results on every node under _env_version, which is
+# bumped whenever it is called with an env different from the previous one.
+# _env_snapshot keeps a copy of that env, so an array mutated in place counts
+# as a change too.
+_env_version = 0
+_env_snapshot = None
+
+
+def _same_env(env, snapshot):
+    if snapshot is None or env.keys() != snapshot.keys():
+        return False
+    for name, value in env.items():
+        old = snapshot[name]
+        # type() keeps {"x": 3} and {"x": 3.0} apart, they give different results.
+        if type(value) is not type(old) or getattr(value, "shape", None) != getattr(old, "shape", None):
+            return False
+        equal = value == old
+        # Arrays compare element-wise.
+        if not (equal.all() if hasattr(equal, "all") else equal):
+            return False
+    return True
 
 
 class Expr(object):
-    pass
-
+    @classmethod
+    def _cons(cls, key, **fields):
+        key = (cls,) + key
+        expr = _cons_cache.get(key)
+        if expr is None:
+            expr = object.__new__(cls)
+            expr.__dict__.update(fields)
+            expr._fwd_cache = None
+            _cons_cache[key] = expr
+        return expr
+
+    # eval, derive_symbolic and simplify walk the DAG with a memo dict that
+    # lives for one call, so a shared subexpression is visited once.
     def eval(self, env):
+        return self._eval(env, {})
+
+    def _eval(self, env, memo):
         raise NotImplementedError
 
     def derive_symbolic(self, var):
+        return self._derive_symbolic(var, {}).simplify()
+
+    def _derive_symbolic(self, var, memo):
         raise NotImplementedError
 
     def derive_forward(self, env, var):
+        global _env_version, _env_snapshot
+        if not _same_env(env, _env_snapshot):
+            _env_version += 1
+            _env_snapshot = {name: value.copy() if hasattr(value, "copy") else value
+                             for name, value in env.items()}
+        return self._derive_forward_memo(env, _env_version, var)
+
+    def _derive_forward_memo(self, env, env_version, var):
+        """Cache (value, tangent) per node. The value only depends on env, so it
+        is stored once per env_version and shared by the tangents of every var."""
+        if self._fwd_cache is None or self._fwd_cache[0] != env_version:
+            self._fwd_cache = (env_version, None, {})
+        _, value, tangents = self._fwd_cache
+        if var not in tangents:
+            value, tangents[var] = self._derive_forward(env, env_version, var)
+            self._fwd_cache = (env_version, value, tangents)
+        return (value, tangents[var])
+
+    def _derive_forward(self, env, env_version, var):
         raise NotImplementedError
 
     def simplify(self):
+        return self._simplify({})
+
+    def _simplify(self, memo):
         raise NotImplementedError
 
+    def _rewrite_to_fixed_point(self):
+        """Apply _rewrite at this node until it stops changing. The children
+        must already be simplified; every rewrite only returns nodes whose
+        children are simplified too, so nothing below needs another pass."""
+        cur, nxt = self, self._rewrite()
+        while nxt is not cur:
+            cur, nxt = nxt, nxt._rewrite()
+        return cur
+
+    def _rewrite(self):
+        return self
+
     def __repr__(self):
         raise NotImplementedError
 
+    # Hash-consing makes structurally equal expressions the same object.
     def __eq__(self, other):
-        raise NotImplementedError
+        return self is other
+
+    def __hash__(self):
+        return id(self)
 
 
 class NumberExpr(Expr):
-    def __init__(self, num):
-        super()
-        self.num = num
+    def __new__(cls, num):
+        # type(num) keeps 1 and 1.0 apart, they print differently.
+        return cls._cons((type(num), num), num=num)
 
     def __repr__(self):
         return f"{self.num}"
 
-    def eval(self, env):
+    def _eval(self, env, memo):
         return self.num
 
-    def derive_symbolic(self, var):
-        return NumberExpr(0)
+    def _derive_symbolic(self, var, memo):
+        return ZERO
 
-    def simplify(self):
+    def _simplify(self, memo):
         return self
 
+    # Numbers compare by value so the simplify identities also match 0.0 and 1.0.
     def __eq__(self, other):
-        if not isinstance(other, NumberExpr):
-            return False
-        return self.num == other.num
+        return isinstance(other, NumberExpr) and self.num == other.num
 
-    def derive_forward(self, env, var):
+    def __hash__(self):
+        return hash(self.num)
+
+    def _derive_forward(self, env, env_version, var):
         return (self.num, 0)
 
 
 class AddExpr(Expr):
-    def __init__(self, lhs, rhs):
-        super()
-        self.lhs = lhs
-        self.rhs = rhs
+    def __new__(cls, lhs, rhs):
+        return cls._cons((id(lhs), id(rhs)), lhs=lhs, rhs=rhs)
 
     def __repr__(self):
         return f"({self.lhs} + {self.rhs})"
 
-    def eval(self, env):
-        return self.lhs.eval(env) + self.rhs.eval(env)
-
-    def derive_symbolic(self, var):
-        return AddExpr(self.lhs.derive_symbolic(var), self.rhs.derive_symbolic(var))
-
-    def simplify(self):
-        simplified_lhs = self.lhs.simplify()
-        simplified_rhs = self.rhs.simplify()
-
-        if simplified_lhs == NumberExpr(0):
-            return simplified_rhs
-        if simplified_rhs == NumberExpr(0):
-            return simplified_lhs
-        return AddExpr(simplified_lhs, simplified_rhs)
-
-    def __eq__(self, other):
-        if not isinstance(other, AddExpr):
-            return False
-        return (self.lhs == other.lhs) and (self.rhs == other.rhs)
+    def _eval(self, env, memo):
+        if self not in memo:
+            memo[self] = self.lhs._eval(env, memo) + self.rhs._eval(env, memo)
+        return memo[self]
+
+    def _derive_symbolic(self, var, memo):
+        if self not in memo:
+            memo[self] = AddExpr(self.lhs._derive_symbolic(var, memo), self.rhs._derive_symbolic(var, memo))
+        return memo[self]
+
+    def _simplify(self, memo):
+        if self not in memo:
+            memo[self] = AddExpr(self.lhs._simplify(memo), self.rhs._simplify(memo))._rewrite_to_fixed_point()
+        return memo[self]
+
+    def _rewrite(self):
+        if isinstance(self.lhs, NumberExpr) and isinstance(self.rhs, NumberExpr):
+            return NumberExpr(self.lhs.num + self.rhs.num)
+        if self.lhs == ZERO:
+            return self.rhs
+        if self.rhs == ZERO:
+            return self.lhs
+        if self.lhs is self.rhs:
+            return TimesExpr(NumberExpr(2), self.lhs)
+        return self
 
-    def derive_forward(self, env, var):
-        lhs, lhs_prime = self.lhs.derive_forward(env, var)
-        rhs, rhs_prime = self.rhs.derive_forward(env, var)
+    def _derive_forward(self, env, env_version, var):
+        lhs, lhs_prime = self.lhs._derive_forward_memo(env, env_version, var)
+        rhs, rhs_prime = self.rhs._derive_forward_memo(env, env_version, var)
         return (lhs+rhs, lhs_prime+rhs_prime)
 
 
 class TimesExpr(Expr):
-    def __init__(self, lhs, rhs):
-        super()
-        self.lhs = lhs
-        self.rhs = rhs
+    def __new__(cls, lhs, rhs):
+        return cls._cons((id(lhs), id(rhs)), lhs=lhs, rhs=rhs)
 
     def __repr__(self):
         return f"({self.lhs} * {self.rhs})"
 
-    def eval(self, env):
-        return self.lhs.eval(env) * self.rhs.eval(env)
-
-    def derive_symbolic(self, var):
-        return AddExpr(
-            TimesExpr(self.lhs.derive_symbolic(var), self.rhs),
-            TimesExpr(self.lhs, self.rhs.derive_symbolic(var))
-        )
-
-    def simplify(self):
-        simplified_lhs = self.lhs.simplify()
-        simplified_rhs = self.rhs.simplify()
-
-        if simplified_lhs == NumberExpr(0):
-            return NumberExpr(0)
-        if simplified_rhs == NumberExpr(0):
-            return NumberExpr(0)
-        if simplified_lhs == NumberExpr(1):
-            return simplified_rhs
-        if simplified_rhs == NumberExpr(1):
-            return simplified_lhs
-        return TimesExpr(simplified_lhs, simplified_rhs)
-
-    def __eq__(self, other):
-        if not isinstance(other, TimesExpr):
-            return False
-        return (self.lhs == other.lhs) and (self.rhs == other.rhs)
+    def _eval(self, env, memo):
+        if self not in memo:
+            memo[self] = self.lhs._eval(env, memo) * self.rhs._eval(env, memo)
+        return memo[self]
+
+    def _derive_symbolic(self, var, memo):
+        if self not in memo:
+            memo[self] = AddExpr(
+                TimesExpr(self.lhs._derive_symbolic(var, memo), self.rhs),
+                TimesExpr(self.lhs, self.rhs._derive_symbolic(var, memo))
+            )
+        return memo[self]
+
+    def _simplify(self, memo):
+        if self not in memo:
+            memo[self] = TimesExpr(self.lhs._simplify(memo), self.rhs._simplify(memo))._rewrite_to_fixed_point()
+        return memo[self]
+
+    def _rewrite(self):
+        if isinstance(self.lhs, NumberExpr) and isinstance(self.rhs, NumberExpr):
+            return NumberExpr(self.lhs.num * self.rhs.num)
+        if self.lhs == ZERO:
+            return self.lhs
+        if self.rhs == ZERO:
+            return self.rhs
+        if self.lhs == ONE:
+            return self.rhs
+        if self.rhs == ONE:
+            return self.lhs
+        return self
 
-    def derive_forward(self, env, var):
-        lhs, lhs_prime = self.lhs.derive_forward(env, var)
-        rhs, rhs_prime = self.rhs.derive_forward(env, var)
+    def _derive_forward(self, env, env_version, var):
+        lhs, lhs_prime = self.lhs._derive_forward_memo(env, env_version, var)
+        rhs, rhs_prime = self.rhs._derive_forward_memo(env, env_version, var)
         return (lhs*rhs, lhs_prime*rhs+lhs*rhs_prime)
 
 
 class VarExpr(Expr):
-    def __init__(self, name):
-        super()
-        self.name = name
+    def __new__(cls, name):
+        return cls._cons((name,), name=name)
 
     def __repr__(self):
         return f"{self.name}"
 
-    def eval(self, env):
+    def _eval(self, env, memo):
         return env[self.name]
 
-    def derive_symbolic(self, var):
-        return NumberExpr(1 if var == self.name else 0)
+    def _derive_symbolic(self, var, memo):
+        return ONE if var == self.name else ZERO
 
-    def simplify(self):
+    def _simplify(self, memo):
         return self
 
-    def __eq__(self, other):
-        if not isinstance(other, VarExpr):
-            return False
-        return self.name == other.name
-
-    def derive_forward(self, env, var):
+    def _derive_forward(self, env, env_version, var):
         return (env[self.name], 1 if self.name == var else 0)
 
 
+ZERO = NumberExpr(0)
+ONE = NumberExpr(1)
+
+
 class Tests(unittest.TestCase):
     def test_repr(self):
         self.assertEqual(repr(TimesExpr(NumberExpr(2), AddExpr(
@@ -176,16 +265,53 @@ class Tests(unittest.TestCase):
         self.assertEqual(
             AddExpr(NumberExpr(0), NumberExpr(2)).simplify(), NumberExpr(2))
 
+    def test_simplify_constant_folding(self):
+        self.assertEqual(
+            AddExpr(NumberExpr(2), NumberExpr(3)).simplify(), NumberExpr(5))
+        self.assertEqual(
+            TimesExpr(NumberExpr(2), NumberExpr(3)).simplify(), NumberExpr(6))
+        self.assertEqual(TimesExpr(AddExpr(NumberExpr(1), NumberExpr(2)), AddExpr(
+            VarExpr("x"), NumberExpr(0))).simplify(), TimesExpr(NumberExpr(3), VarExpr("x")))
+        self.assertEqual(AddExpr(VarExpr("x"), VarExpr("x")).simplify(),
+                         TimesExpr(NumberExpr(2), VarExpr("x")))
+        self.assertEqual(TimesExpr(AddExpr(NumberExpr(0.5), NumberExpr(-0.5)),
+                                   VarExpr("x")).simplify(), NumberExpr(0))
+        self.assertEqual(TimesExpr(NumberExpr(1.0), AddExpr(
+            VarExpr("x"), NumberExpr(0.0))).simplify(), VarExpr("x"))
+
     def test_derive_symbolic(self):
         self.assertEqual(TimesExpr(NumberExpr(2), AddExpr(
-            VarExpr("x"), NumberExpr(4))).derive_symbolic("x"), AddExpr(
-                TimesExpr(NumberExpr(0), AddExpr(VarExpr("x"), NumberExpr(4))),
-                TimesExpr(NumberExpr(2), AddExpr(
-                    NumberExpr(1), NumberExpr(0)))))
+            VarExpr("x"), NumberExpr(4))).derive_symbolic("x"), NumberExpr(2))
 
         self.assertEqual(TimesExpr(NumberExpr(2), AddExpr(
             VarExpr("x"), NumberExpr(4))).derive_symbolic("x").simplify(), NumberExpr(2))
 
+        self.assertEqual(TimesExpr(VarExpr("x"), VarExpr("x")).derive_symbolic("x"),
+                         TimesExpr(NumberExpr(2), VarExpr("x")))
+
+    def test_hash_consing(self):
+        self.assertIs(AddExpr(VarExpr("x"), NumberExpr(4)),
+                      AddExpr(VarExpr("x"), NumberExpr(4)))
+        self.assertIsNot(NumberExpr(1), NumberExpr(1.0))
+        self.assertEqual(NumberExpr(2), NumberExpr(2.0))
+
+        expr = TimesExpr(AddExpr(VarExpr("x"), NumberExpr(4)), VarExpr("y"))
+        self.assertIs(expr.derive_symbolic("y"), expr.lhs)
+
+        AddExpr(VarExpr("unused"), NumberExpr(4))
+        self.assertNotIn((VarExpr, "unused"), _cons_cache)
+
+    def test_shared_subexpressions(self):
+        # e_{n+1} = e_n * (e_n + y): a tree walk would visit e_0 2^40 times.
+        expr = VarExpr("x")
+        for _ in range(40):
+            expr = TimesExpr(expr, AddExpr(expr, VarExpr("y")))
+
+        env = {"x": 1, "y": 0}
+        self.assertEqual(expr.eval(env), 1)
+        self.assertEqual(expr.simplify(), expr)
+        self.assertEqual(expr.derive_symbolic("x").eval(env), 2**40)
+
     def test_derive_computational(self):
         expr = TimesExpr(NumberExpr(2), AddExpr(VarExpr("x"), NumberExpr(4)))
 
@@ -194,6 +320,39 @@ class Tests(unittest.TestCase):
             self.assertAlmostEqual(
                 (expr.eval({"x": 1+h})-expr.eval({"x": 1}))/h, 2)
 
+    def test_derive_forward_memo(self):
+        expr = TimesExpr(VarExpr("x"), AddExpr(VarExpr("x"), VarExpr("y")))
+        env = {"x": 1, "y": 2}
+        self.assertEqual(expr.derive_forward(env, "x"), (3, 4))
+        self.assertEqual(expr.derive_forward(env, "y"), (3, 1))
+        self.assertEqual(expr.derive_forward(env, "x"), (3, 4))
+
+        env["y"] = 5
+        self.assertEqual(expr.derive_forward(env, "x"), (6, 7))
+
+        value, tangent = expr.derive_forward({"x": 1.0, "y": 5}, "x")
+        self.assertIs(type(value), float)
+        self.assertIs(type(tangent), float)
+
+    def test_derive_forward_array_env(self):
+        import numpy as np
+
+        expr = TimesExpr(VarExpr("x"), AddExpr(VarExpr("x"), VarExpr("y")))
+        x = np.array([1., 2.])
+        value, tangent = expr.derive_forward({"x": x, "y": 5}, "x")
+        self.assertEqual(value.tolist(), [6., 14.])
+        self.assertEqual(tangent.tolist(), [7., 9.])
+
+        # The same array again, changed in place since the last call.
+        x[0] = 3.
+        value, tangent = expr.derive_forward({"x": x, "y": 5}, "x")
+        self.assertEqual(value.tolist(), [24., 14.])
+        self.assertEqual(tangent.tolist(), [11., 9.])
+
+        value, tangent = expr.derive_forward({"x": np.array([2., 2.]), "y": 5}, "x")
+        self.assertEqual(value.tolist(), [14., 14.])
+        self.assertEqual(tangent.tolist(), [9., 9.])
+
     def test_derive_forward(self):
         expr = TimesExpr(NumberExpr(2), AddExpr(VarExpr("x"), NumberExpr(4)))
         self.assertEqual(expr.eval({"x": 1}), 10)